@@ -2,7 +2,8 @@
 
 """
 usage: hex2boot.py [-h] [-v] -o OUT [-b {0,1}] [-e {0,1,2}] [-i [ID [ID ...]]]
-                   [-l LOCK] [-m {bb2,sb2,ub1}] [-s ADDR] [-t ADDR] [-w]
+                   [-l LOCK] [-m {bb2,bb50,bb51,bb52,sb2,ub1}] [-r N]
+                   [-s ADDR] [-t ADDR] [-w]
                    [hexfile]
 
 Hex to Boot Record conversion utility.
@@ -25,12 +26,12 @@ conversion parameters:
   -l LOCK, --lock LOCK  lock value (default=None)
   -m {bb2,bb50,bb51,bb52,sb2,ub1}, --map {bb2,bb50,bb51,bb52,sb2,ub1}
                         special map type (default: None)
+  -r N, --record-size N
+                        data bytes per write record (default=128, max=252)
   -s ADDR, --start ADDR
                         start address (default=0)
   -t ADDR, --top ADDR   top address (default=65535)
   -w, --wait            remain in bootloader mode (default: False)
----
-# TODO: Skip page size holes
 """
 
 epilog = """
@@ -39,8 +40,10 @@ the specified address range.
 """
 
 import argparse
+import array
 import intelhex
 import struct
+from concurrent.futures import ThreadPoolExecutor
 
 VERSION = '1.10'
 
@@ -79,11 +82,59 @@ _CRC16_XMODEM_TABLE = [
     0x6e17, 0x7e36, 0x4e55, 0x5e74, 0x2e93, 0x3eb2, 0x0ed1, 0x1ef0,
     ]
 
-def crc16(data, crc=0, table=_CRC16_XMODEM_TABLE):
-    for byte in bytearray(data):
-        crc = ((crc<<8) & 0xff00) ^ table[((crc>>8) & 0xff) ^ byte]
+try:
+    import crcmod
+    _crc16_native = crcmod.mkCrcFun(0x11021, initCrc=0, rev=False)
+except ImportError:
+    _crc16_native = None
+
+_crc16_numba = None
+if _crc16_native is None:
+    try:
+        import numba
+        import numpy
+        _CRC16_TABLE_NP = numpy.array(_CRC16_XMODEM_TABLE, dtype=numpy.uint16)
+        @numba.njit(cache=True)
+        def _crc16_numba(buf, crc, table):
+            for byte in buf:
+                crc = ((crc<<8) & 0xff00) ^ table[((crc>>8) & 0xff) ^ byte]
+            return crc & 0xffff
+        # warm-compile once so the first record doesn't pay for it
+        _crc16_numba(numpy.frombuffer(b'\x00', dtype=numpy.uint8), 0, _CRC16_TABLE_NP)
+    except ImportError:
+        _crc16_numba = None
+
+def _sb8_tables(table):
+    # tables[k][x] = CRC of byte x followed by k zero bytes
+    tables = [table]
+    for _ in range(7):
+        prev = tables[-1]
+        tables.append([((crc<<8) & 0xff00) ^ table[crc>>8] for crc in prev])
+    # array('H') indexing returns unboxed ints faster than list access
+    return [array.array('H', t) for t in tables]
+
+_CRC16_SB8_TABLES = _sb8_tables(_CRC16_XMODEM_TABLE)
+
+def crc16_sb8(data, crc=0):
+    t0, t1, t2, t3, t4, t5, t6, t7 = _CRC16_SB8_TABLES
+    head = len(data) - (len(data) % 8)
+    for i in range(0, head, 8):
+        b0, b1, b2, b3, b4, b5, b6, b7 = data[i:i+8]
+        crc = (t7[(crc>>8) ^ b0] ^ t6[(crc & 0xff) ^ b1] ^
+               t5[b2] ^ t4[b3] ^ t3[b4] ^ t2[b5] ^ t1[b6] ^ t0[b7])
+    for byte in data[head:]:
+        crc = ((crc<<8) & 0xff00) ^ t0[((crc>>8) & 0xff) ^ byte]
     return crc & 0xffff
 
+def crc16(data, crc=0):
+    # bytes, bytearray and memoryview all go through unconverted
+    if _crc16_native is not None:
+        return _crc16_native(data, crc)
+    if _crc16_numba is not None:
+        buf = numpy.frombuffer(data, dtype=numpy.uint8)
+        return int(_crc16_numba(buf, crc, _CRC16_TABLE_NP))
+    return crc16_sb8(data, crc)
+
 FSB = b'$'
 S_IDENT  = struct.Struct('>cBBH')
 S_SETUP  = struct.Struct('>cBBHB')
@@ -114,72 +165,160 @@ def bin_lock(lock):
 def bin_runapp(option=0):
     return S_RUNAPP.pack(FSB, 3, 0x36, option)
 
+def emit_verify(buf, org, end, crc):
+    off = len(buf)
+    buf.extend(bytes(S_VERIFY.size))
+    S_VERIFY.pack_into(buf, off, FSB, 7, 0x34, org, end, crc)
+
+def emit_lock(buf, lock):
+    off = len(buf)
+    buf.extend(bytes(S_LOCK.size))
+    S_LOCK.pack_into(buf, off, FSB, 3, 0x35, lock)
+
+def emit_runapp(buf, option=0):
+    off = len(buf)
+    buf.extend(bytes(S_RUNAPP.size))
+    S_RUNAPP.pack_into(buf, off, FSB, 3, 0x36, option)
+
+_REGIONS = {
+    'bb2': ( ( 0x0000, 0x3DFF,  512 ), ( 0xF800, 0xFBBF, 64 ) ),
+    'bb50': ( ( 0x0000, 0x37FF,  2048), ),
+    'bb51': ( ( 0x0000, 0x37FF,  2048), ),
+    'bb52': ( ( 0x0000, 0x77FF,  2048), ),
+    'sb2': ( ( 0x0000, 0xF7FF, 1024 ), ),
+    'ub1': ( ( 0x0000, 0x3DFF,  512 ), ( 0xF800, 0xFBBF, 64 ) ),
+    }
+
+_DEFAULT_REGIONS = ( ( 0x0000, 0xFBFF, 512 ), )
+
 def regions(type):
-    return {
-        'bb2': [ [ 0x0000, 0x3DFF,  512 ], [ 0xF800, 0xFBBF, 64 ] ],
-        'bb50': [ [ 0x0000, 0x37FF,  2048] ],
-        'bb51': [ [ 0x0000, 0x37FF,  2048] ],
-        'bb52': [ [ 0x0000, 0x77FF,  2048] ],
-        'sb2': [ [ 0x0000, 0xF7FF, 1024 ] ], 
-        'ub1': [ [ 0x0000, 0x3DFF,  512 ], [ 0xF800, 0xFBBF, 64 ] ],
-        }.get(type, [ [ 0x0000, 0xFBFF, 512 ] ])
-    
+    return _REGIONS.get(type, _DEFAULT_REGIONS)
+
 def get_regions(org, top, type):
     for start, stop, page in regions(type):
         if max(org, start) < min(top, stop):
             yield max(org, start), min(top, stop), page
 
-def mem2boot(brec, ih, page=512, erase=2):
-    addresses = ih.addresses()
-    if addresses:
-        crc = 0
-        minaddr = int(addresses[0] / page) * page
-        maxaddr = addresses[-1]
-        recsize = min(128, page)
-        for addr in range(minaddr, maxaddr+1, recsize):
-            size = min(recsize, maxaddr - addr + 1)
-            data = ih.tobinstr(start=addr, size=size)
-            crc = crc16(data, crc)
+def get_segments(ih, start, stop, page):
+    first = last = None
+    for seg_start, seg_stop in ih.segments():
+        lo, hi = max(seg_start, start), min(seg_stop, stop) - 1
+        if lo > hi:
+            continue
+        if first is None:
+            first, last = lo, hi
+        elif (lo // page) * page <= last:
+            # shares a flash page with the previous segment
+            last = hi
+        else:
+            yield first, last
+            first, last = lo, hi
+    if first is not None:
+        yield first, last
+
+def mem2boot(buf, ih, start, stop, page=512, erase=2, recsize=128):
+    if start <= stop:
+        minaddr = (start // page) * page
+        maxaddr = stop
+        recsize = min(recsize, page)
+        full = bytes(ih.tobinarray(start=minaddr, end=maxaddr))
+        crc = crc16(full)
+        hsize = S_WRITE.size
+        scratch = bytearray(hsize + recsize)
+        etmpl = bytearray(bin_erase(0))
+        blank = b'\xff' * recsize
+        addr = minaddr
+        while addr <= maxaddr:
+            # records never straddle a page, so every page starts with
+            # a record and gets its erase
+            size = min(recsize, maxaddr - addr + 1, page - addr % page)
+            data = full[addr-minaddr : addr-minaddr+size]
+            if erase and data == blank[:size]:
+                # hole: the erase alone leaves the page at 0xFF
+                if addr % page == 0:
+                    struct.pack_into('>H', etmpl, 3, addr)
+                    buf += etmpl
+                addr += size
+                continue
             if (erase == 0) or (addr % page):
-                bin = bin_write(addr, data)
+                S_WRITE.pack_into(scratch, 0, FSB, 3+size, 0x33, addr)
             elif erase == 1:
-                bin = bin_erase(addr) + bin_write(addr, data)
+                struct.pack_into('>H', etmpl, 3, addr)
+                buf += etmpl
+                S_WRITE.pack_into(scratch, 0, FSB, 3+size, 0x33, addr)
             else:
-                bin = bin_erase(addr, data)
-            brec.write(bin)
-        brec.write(bin_verify(minaddr, maxaddr, crc))
+                S_ERASE.pack_into(scratch, 0, FSB, 3+size, 0x32, addr)
+            scratch[hsize:hsize+size] = data
+            buf += memoryview(scratch)[:hsize+size]
+            addr += size
+        emit_verify(buf, minaddr, maxaddr, crc)
+
+_FF_BLOCK = b'\xff' * 4096
+_FF_CRC = {}
+
+def crc16_ff(size):
+    crc = _FF_CRC.get(size)
+    if crc is None:
+        crc = 0
+        blocks, rest = divmod(size, len(_FF_BLOCK))
+        for _ in range(blocks):
+            crc = crc16(_FF_BLOCK, crc)
+        if rest:
+            crc = crc16(memoryview(_FF_BLOCK)[:rest], crc)
+        _FF_CRC[size] = crc
+    return crc
 
-def erase2boot(brec, start, stop, page=512):
-    page_start = int(start / page) * page
+def erase2boot(buf, start, stop, page=512):
+    page_start = (start // page) * page
+    etmpl = bytearray(bin_erase(0))
     for addr in range(page_start, stop+1, page):
-        brec.write(bin_erase(addr))
+        struct.pack_into('>H', etmpl, 3, addr)
+        buf += etmpl
     size = stop - start + 1
-    brec.write(bin_verify(start, stop, crc16(b'\xff'*size, 0)))
+    emit_verify(buf, start, stop, crc16_ff(size))
 
 def hex2boot(brec, args):
     failsafe = (args.bank == 0) and (args.start == 0)
+    rlist = list(get_regions(args.start, args.top, args.map))
+    buf = bytearray()
 
     for blid in args.id:
-        brec.write(bin_ident(blid))
-    brec.write(bin_setup(args.bank))
+        buf += bin_ident(blid)
+    buf += bin_setup(args.bank)
 
     if args.hexfile:
         ih = intelhex.IntelHex(args.hexfile)
-        resetv = ih[0]
-        if failsafe and resetv != 0xFF:
+        resetv = ih[0] if failsafe else 0xFF
+        if resetv != 0xFF:
             ih[0] = 0xFF
-        for start, stop, page in get_regions(args.start, args.top, args.map):
-            mem2boot(brec, ih[slice(start, stop)], page, args.erase)
-        if failsafe and resetv != 0xFF:
-            brec.write(bin_write(0, bytearray([resetv])))
+        segments = [(seg_start, seg_stop, page)
+                    for start, stop, page in rlist
+                    for seg_start, seg_stop in get_segments(ih, start, stop, page)]
+        def convert(segment):
+            start, stop, page = segment
+            part = bytearray()
+            mem2boot(part, ih, start, stop, page, args.erase, args.record_size)
+            return part
+        if len(segments) > 1:
+            # mem2boot only reads ih; native CRC calls release the GIL,
+            # so independent segments overlap.  map() keeps the order.
+            with ThreadPoolExecutor() as pool:
+                for part in pool.map(convert, segments):
+                    buf += part
+        elif segments:
+            buf += convert(segments[0])
+        if resetv != 0xFF:
+            buf += bin_write(0, bytearray([resetv]))
     elif args.lock is None:
-        for start, stop, page in get_regions(args.start, args.top, args.map):
-            erase2boot(brec, start, stop, page)
+        for start, stop, page in rlist:
+            erase2boot(buf, start, stop, page)
 
     if args.lock is not None:
-        brec.write(bin_lock(args.lock))
+        emit_lock(buf, args.lock)
     if not args.wait:
-        brec.write(bin_runapp())
+        emit_runapp(buf)
+
+    brec.write(buf)
 
 if __name__ == "__main__":
     def literal(str):
@@ -188,6 +327,12 @@ if __name__ == "__main__":
             raise argparse.ArgumentTypeError("value is too large")
         return value
 
+    def recsize(str):
+        value = int(str, 0)
+        if not 1 <= value <= 252:
+            raise argparse.ArgumentTypeError("record size must be 1..252")
+        return value
+
     ap = argparse.ArgumentParser(description='Hex to Boot Record conversion utility.', epilog=epilog)
     ap.add_argument('-v', '--version', action='version', version='%(prog)s ' + VERSION)
     ap.add_argument('hexfile', nargs='?', help='hex file to convert')
@@ -205,6 +350,8 @@ if __name__ == "__main__":
         help='lock value (default=%(default)s)')
     ag.add_argument('-m', '--map', choices=['bb2', 'bb50', 'bb51', 'bb52', 'sb2', 'ub1'], 
         help='special map type (default: %(default)s)')
+    ag.add_argument('-r', '--record-size', default=128, type=recsize, metavar='N', 
+        help='data bytes per write record (default=%(default)s, max=252)')
     ag.add_argument('-s', '--start', default=0, type=literal, metavar='ADDR', 
         help='start address (default=%(default)s)')
     ag.add_argument('-t', '--top', default=0xFFFF, type=literal, metavar='ADDR', 